@@ -1,7 +1,11 @@
 import streamlit as st
 import streamlit.components.v1 as components
-from PIL import Image
+import random
+import uuid
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
 import utils
+import render_scheduler
 import importlib
 importlib.reload(utils)
 
@@ -25,9 +29,115 @@ def load_css(file_name):
 def reset_session():
     st.session_state.captures = []
     st.session_state.temp_image = None
+    st.session_state.burst_frames = []
+    st.session_state.burst_scores = None
+    st.session_state.print_job = None
+    st.session_state.download_job = None
+    st.session_state.filter_cache = None
+    st.session_state.pattern_seed = random.getrandbits(32)
     st.session_state.step = 1
     st.session_state.uploader_key += 1
 
+@st.cache_resource
+def get_render_scheduler():
+    """One render process pool shared by every session, with fair per-session queuing"""
+    return render_scheduler.RenderScheduler()
+
+@st.cache_resource
+def get_quality_controller():
+    """Load-aware switch between full and fast interactive renders, shared across sessions"""
+    return render_scheduler.QualityController(get_render_scheduler())
+
+@st.fragment(run_every=1.0)
+def wait_for_job(state_key, message):
+    """Poll a background job kept in session state; rerun the page once it has finished"""
+    job = st.session_state.get(state_key)
+    if job is None or job[1].done():
+        st.rerun()
+    st.caption(message)
+
+def wait_render(job):
+    """
+    Wait for a render job; if a pool worker died, show an error instead of a traceback.
+    Waits in short ticks and touches a placeholder each tick: Streamlit only stops a
+    superseded run when the script sends it an element, and the next run's begin_run
+    then cancels whatever this run left queued.
+    """
+    try:
+        while True:
+            try:
+                return job.result(timeout=0.1)
+            except FutureTimeout:
+                wait_ticker.empty()
+    except CancelledError:
+        # A newer run of this session superseded the job; this run's output is stale anyway
+        st.stop()
+    except BrokenProcessPool:
+        st.error("The renderer restarted while working on your photos. Please try again.")
+        st.stop()
+
+def render_strip(captures, filter_name, flip, strip_options, quality, priority=render_scheduler.INTERACTIVE):
+    """Process captures and build the strip on the render pool at the given quality"""
+    generation = run_id if priority == render_scheduler.INTERACTIVE else None
+    jobs = [
+        scheduler.submit(
+            session_id, utils.process_image, img, filter_name, flip=flip,
+            size=int(600 * quality["scale"]), fast=quality["fast"], priority=priority, generation=generation
+        )
+        for img in captures
+    ]
+    processed = [wait_render(job) for job in jobs]
+    return wait_render(scheduler.submit(
+        session_id, utils.create_strip, processed,
+        scale=quality["scale"],
+        priority=priority, generation=generation, **strip_options
+    ))
+
+def get_filter_cache(image, flip, quality):
+    """Per-capture cache of the prepared base, contact-sheet thumbnails and filtered renders"""
+    fc = st.session_state.get("filter_cache")
+    key = (flip, quality["scale"], quality["fast"])
+    if fc is None or fc["image"] is not image or fc["key"] != key:
+        fc = {"image": image, "key": key, "base": None, "thumbs": {}, "renders": {}}
+        st.session_state.filter_cache = fc
+    return fc
+
+def render_review(image, filter_name, flip, quality):
+    """Filtered review image; reuses the contact sheet's prepared base when available"""
+    fc = get_filter_cache(image, flip, quality)
+    if filter_name not in fc["renders"]:
+        if fc["base"] is not None:
+            job = scheduler.submit(
+                session_id, utils.apply_filter, fc["base"], filter_name, fast=quality["fast"], generation=run_id
+            )
+        else:
+            job = scheduler.submit(
+                session_id, utils.process_image, image, filter_name, flip=flip,
+                size=int(600 * quality["scale"]), fast=quality["fast"], generation=run_id
+            )
+        fc["renders"][filter_name] = wait_render(job)
+    return fc["renders"][filter_name]
+
+def load_contact_sheet(image, flip, quality):
+    """Thumbnails of every film stock from a single render job"""
+    fc = get_filter_cache(image, flip, quality)
+    if not fc["thumbs"]:
+        fc["base"], fc["thumbs"] = wait_render(scheduler.submit(
+            session_id, utils.filter_contact_sheet, image, flip=flip,
+            size=int(600 * quality["scale"]), fast=quality["fast"], generation=run_id
+        ))
+    return fc["thumbs"]
+
+def select_filter(filter_name):
+    st.session_state.filter_select = filter_name
+
+def select_burst_winner(frames):
+    """Score a burst at low resolution and stage only the sharpest frame for review"""
+    best, scores = utils.pick_sharpest(frames)
+    st.session_state.temp_image = frames[best]
+    st.session_state.burst_frames = []
+    st.session_state.burst_scores = (best, scores)
+
 def get_live_filter_css(filter_name, mirror):
     """Generate CSS for live camera preview with filters and mirroring"""
     transform = "scaleX(-1)" if mirror else "scaleX(1)"
@@ -173,6 +283,24 @@ if 'temp_image' not in st.session_state:
     st.session_state.temp_image = None
 if 'uploader_key' not in st.session_state:
     st.session_state.uploader_key = 0
+if 'burst_frames' not in st.session_state:
+    st.session_state.burst_frames = []
+if 'burst_scores' not in st.session_state:
+    st.session_state.burst_scores = None
+if 'pattern_seed' not in st.session_state:
+    st.session_state.pattern_seed = random.getrandbits(32)
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+# --- Render Scheduler ---
+scheduler = get_render_scheduler()
+session_id = st.session_state.session_id
+st.session_state.run_id = st.session_state.get("run_id", 0) + 1
+run_id = st.session_state.run_id
+scheduler.begin_run(session_id, run_id)
+quality = get_quality_controller().settings()
+full_quality = render_scheduler.QUALITY_SETTINGS[render_scheduler.FULL]
+wait_ticker = st.empty()  # touched by wait_render so a rerun can interrupt a blocked wait
 
 # --- Load Styles ---
 load_css("style.css")
@@ -182,8 +310,12 @@ with st.sidebar:
     st.image("assets/logo.png", use_container_width=True)
     st.markdown("### 🛠️ Booth Settings")
     
-    strip_length = st.radio("Photos per Strip:", (3, 4), horizontal=True, key="strip_len_radio")
+    layout = st.selectbox("Layout:", list(utils.LAYOUTS), key="layout_select")
+    # Always rendered (disabled for grid layouts) so the chosen length survives a layout switch
+    strip_length = st.radio("Photos per Strip:", (3, 4), horizontal=True, key="strip_len_radio",
+                            disabled=layout != "Classic Strip")
     mirror_mode = st.toggle("Mirror Camera", value=True, key="mirror_toggle")
+    burst_mode = st.toggle("Burst Mode (auto-pick sharpest)", value=False, key="burst_toggle")
     
     st.markdown("### 🎨 Aesthetics")
     filter_option = st.selectbox(
@@ -205,6 +337,8 @@ with st.sidebar:
     pattern_type = st.selectbox("Border Pattern:", ["None", "Polka Dots", "Stars", "Confetti", "Minimal Lines"], key="pattern_select")
     
     sticker_density = st.slider("Pattern Intensity:", 1, 10, 5, key="pattern_density_slider")
+    if pattern_type != "None" and st.button("🎲 Shuffle Pattern", use_container_width=True, key="shuffle_pattern_button"):
+        st.session_state.pattern_seed = random.getrandbits(32)
 
     st.markdown("### 📝 Strip Footer")
     footer_text = st.text_input("Footer Text:", value="Little Vintage Photobooth", key="footer_text_input")
@@ -223,6 +357,18 @@ with st.sidebar:
         index=0,
         key="font_style_select"
     )
+
+    # Only shown when the operator has configured printer profiles (PHOTOBOOTH_ICC_DIR)
+    print_export = False
+    print_profile = None
+    print_intent = "Perceptual"
+    print_profiles = utils.list_print_profiles()
+    if print_profiles:
+        st.markdown("### 🖨️ Print Export")
+        print_export = st.checkbox("Color-managed print file", value=False, key="print_export_check")
+        if print_export:
+            print_profile = st.selectbox("Printer Profile:", print_profiles, key="print_profile_select")
+            print_intent = st.selectbox("Rendering Intent:", list(utils.RENDERING_INTENTS), key="print_intent_select")
         
     st.markdown("---")
     if st.button("🔄 Reset / New Session", type="primary", use_container_width=True, key="reset_button"):
@@ -239,7 +385,7 @@ spacer_l, center_col, spacer_r = st.columns([1, 2, 1])
 with center_col:
     st.markdown('<h1 class="main-title">Vintage Photobooth</h1>', unsafe_allow_html=True)
     
-    needed_photos = strip_length
+    needed_photos = utils.layout_photo_count(layout, strip_length)
     current_count = len(st.session_state.captures)
     
     if current_count < needed_photos:
@@ -249,27 +395,47 @@ with center_col:
                 Pose {current_count + 1} / {needed_photos}
             </div>
         """, unsafe_allow_html=True)
+        if quality is not full_quality:
+            st.caption("⚡ Busy booth: showing a quick preview. Your strip downloads in full quality.")
         
         st.markdown('<div class="booth-container">', unsafe_allow_html=True)
         
         # Check if we have a pending image to review
         if st.session_state.temp_image:
              # --- REVIEW STEP (WYSIWYG) ---
-             review_img = utils.process_image(st.session_state.temp_image, filter_option, flip=mirror_mode)
-             st.image(review_img, caption="Does this look good?", use_container_width=True)
+             review_img = render_review(st.session_state.temp_image, filter_option, mirror_mode, quality)
+             st.image(review_img, caption="Does this look good?", use_container_width=True,
+                      output_format=quality["output_format"])
+             if st.session_state.burst_scores:
+                 best, scores = st.session_state.burst_scores
+                 st.caption(f"Sharpest of {len(scores)} frames (#{best + 1})")
              
              col_rev1, col_rev2 = st.columns(2)
              with col_rev1:
                  if st.button("❌ Retake", use_container_width=True):
                      st.session_state.temp_image = None
+                     st.session_state.burst_scores = None
                      st.session_state.uploader_key += 1
                      st.rerun()
              with col_rev2:
                  if st.button("✅ Keep It", type="primary", use_container_width=True):
                      st.session_state.captures.append(st.session_state.temp_image)
                      st.session_state.temp_image = None
+                     st.session_state.burst_scores = None
                      st.session_state.uploader_key += 1
                      st.rerun()
+
+             # --- FILTER CONTACT SHEET ---
+             if st.toggle("🎞️ Compare All Film Stocks", value=False, key="contact_sheet_toggle"):
+                 thumbs = load_contact_sheet(st.session_state.temp_image, mirror_mode, quality)
+                 names = list(thumbs)
+                 for row in range(0, len(names), 3):
+                     for col, name in zip(st.columns(3), names[row:row + 3]):
+                         with col:
+                             st.image(thumbs[name], caption=name, use_container_width=True)
+                             st.button("✓ Selected" if name == filter_option else "Use", key=f"sheet_{name}",
+                                       on_click=select_filter, args=(name,), disabled=name == filter_option,
+                                       use_container_width=True)
         else:
             # --- CAMERA INPUT ---
             tab1, tab2 = st.tabs(["📷 Camera", "📤 Upload"])
@@ -279,17 +445,32 @@ with center_col:
                 photo = st.camera_input("Pose!", key=camera_key, label_visibility="collapsed")
                 
                 if photo:
-                    st.session_state.temp_image = Image.open(photo).copy()
+                    if burst_mode:
+                        # Collect repeated grabs; the camera resets for the next one
+                        st.session_state.burst_frames.append(utils.load_capture(photo))
+                        st.session_state.uploader_key += 1
+                    else:
+                        st.session_state.temp_image = utils.load_capture(photo)
                     st.rerun()
+
+                if burst_mode and st.session_state.burst_frames:
+                    n_frames = len(st.session_state.burst_frames)
+                    if st.button(f"🎯 Use Sharpest of {n_frames}", type="primary", use_container_width=True):
+                        select_burst_winner(st.session_state.burst_frames)
+                        st.rerun()
                     
             with tab2:
                 upload_key = f"uploader_{st.session_state.uploader_key}"
-                uploaded = st.file_uploader("Upload Image", type=['jpg', 'png', 'jpeg'], key=upload_key, label_visibility="collapsed")
+                uploaded = st.file_uploader("Upload Image", type=['jpg', 'png', 'jpeg'], key=upload_key,
+                                            accept_multiple_files=burst_mode, label_visibility="collapsed")
                 
                 if uploaded:
                     try:
-                        img = Image.open(uploaded).copy()
-                        st.session_state.temp_image = img
+                        if burst_mode:
+                            select_burst_winner([utils.load_capture(f) for f in uploaded])
+                        else:
+                            img = utils.load_capture(uploaded)
+                            st.session_state.temp_image = img
                         st.rerun()
                     except Exception as e:
                         st.error("Error loading image. Try another one.")
@@ -303,14 +484,11 @@ with center_col:
                 Strip Ready
             </div>
         """, unsafe_allow_html=True)
+        if quality is not full_quality:
+            st.caption("⚡ Busy booth: showing a quick preview. Your strip downloads in full quality.")
         
         # Process Captures
-        processed_captures = []
-        for img in st.session_state.captures:
-            processed_captures.append(utils.process_image(img, filter_option, flip=mirror_mode))
-            
-        final_strip = utils.create_strip(
-            processed_captures, 
+        strip_options = dict(
             footer_text=footer_text, 
             frame_style=frame_style,
             text_color=text_color,
@@ -318,23 +496,81 @@ with center_col:
             custom_border_color=custom_border_color,
             pattern_type=pattern_type,
             sticker_density=sticker_density,
-            font_style=font_style
+            font_style=font_style,
+            layout=layout,
+            pattern_seed=st.session_state.pattern_seed
         )
+        strip_captures = st.session_state.captures[:needed_photos]
+        final_strip = render_strip(strip_captures, filter_option, mirror_mode, strip_options, quality)
         
-        st.image(final_strip, caption=f"{filter_option} • {frame_style} • {pattern_type}", use_container_width=True)
+        st.image(final_strip, caption=f"{filter_option} • {frame_style} • {pattern_type}", use_container_width=True,
+                 output_format=quality["output_format"])
+
+        # Downloads are always full quality. At full quality the preview strip is encoded
+        # right here; a degraded preview hands the full render to a background job keyed
+        # on the settings, so the page never waits on it.
+        download_key = (
+            tuple(id(img) for img in strip_captures), filter_option, mirror_mode,
+            tuple(sorted(strip_options.items())),
+        )
+        download_job = st.session_state.get("download_job")
+        if download_job is None or download_job[0] != download_key or (
+                quality is full_quality and not download_job[1].done()):
+            if quality is full_quality:
+                future = Future()
+                future.set_result((final_strip, utils.convert_to_bytes(final_strip)))
+            else:
+                future = scheduler.submit(
+                    session_id, utils.render_download, strip_captures, filter_option, flip=mirror_mode,
+                    priority=render_scheduler.DOWNLOAD, **strip_options
+                )
+            st.session_state.download_job = download_job = (download_key, future)
         
         # Controls
         c1, c2 = st.columns(2)
         with c1:
-            strip_bytes = utils.convert_to_bytes(final_strip)
-            st.download_button(
-                label="⬇️ Download Strip",
-                data=strip_bytes,
-                file_name="photobooth_strip.png",
-                mime="image/png",
-                use_container_width=True
-            )
+            future = download_job[1]
+            if not future.done():
+                wait_for_job("download_job", "⏳ Preparing your full-quality download...")
+            elif future.exception() is not None:
+                st.error(f"Download failed: {future.exception()}")
+                st.session_state.download_job = None
+            else:
+                strip_bytes = future.result()[1]
+                st.download_button(
+                    label="⬇️ Download Strip",
+                    data=strip_bytes,
+                    file_name="photobooth_strip.png",
+                    mime="image/png",
+                    use_container_width=True
+                )
         with c2:
              if st.button("✨ New Session", use_container_width=True):
                 reset_session()
                 st.rerun()
+
+        # Print Export (converted in the render pool from the download strip, picked up on a later rerun)
+        if print_export and print_profile and download_job[1].done() and not download_job[1].exception():
+            export_key = download_key + (print_profile, print_intent)
+            job = st.session_state.get("print_job")
+            if job is None or job[0] != export_key:
+                future = scheduler.submit(
+                    session_id, utils.export_for_print, download_job[1].result()[0], print_profile, print_intent,
+                    priority=render_scheduler.DOWNLOAD
+                )
+                st.session_state.print_job = job = (export_key, future)
+
+            future = job[1]
+            if not future.done():
+                wait_for_job("print_job", "Preparing print file...")
+            elif future.exception() is not None:
+                st.error(f"Print export failed: {future.exception()}")
+            else:
+                print_bytes, print_mime, print_ext = future.result()
+                st.download_button(
+                    label="🖨️ Download Print File",
+                    data=print_bytes,
+                    file_name=f"photobooth_strip_print.{print_ext}",
+                    mime=print_mime,
+                    use_container_width=True
+                )
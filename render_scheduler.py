@@ -0,0 +1,291 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# --- PRIORITIES ---
+# Lower number runs first
+INTERACTIVE = 0   # review / strip preview the guest is waiting on
+DOWNLOAD = 1      # full-resolution renders and print exports
+
+PRIORITIES = (INTERACTIVE, DOWNLOAD)
+
+logger = logging.getLogger(__name__)
+
+
+def _call(module_name, fn_name, args, kwargs):
+    """
+    Worker-side trampoline. Jobs travel as (module, function name) and are
+    resolved here, so a session calling importlib.reload(utils) while other
+    sessions' jobs are queued cannot leave the pool holding a function object
+    that no longer pickles as utils.<name>.
+    """
+    fn = getattr(importlib.import_module(module_name), fn_name)
+    return fn(*args, **kwargs)
+
+
+class _Job:
+    __slots__ = ("session_id", "module", "name", "args", "kwargs", "future", "priority", "submitted",
+                 "generation")
+
+    def __init__(self, session_id, fn, args, kwargs, priority, generation):
+        self.session_id = session_id
+        self.module = fn.__module__
+        self.name = fn.__name__
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.priority = priority
+        self.submitted = time.monotonic()
+        self.generation = generation
+
+
+class RenderScheduler:
+    """
+    Process-pool render scheduler shared by every Streamlit session.
+
+    Jobs are queued per priority level and, inside a level, per session.
+    The dispatcher always serves the highest non-empty priority and takes
+    one job from each session in turn, so a session queueing a 4-photo
+    strip cannot starve another booth's single review render. Only as many
+    jobs as there are workers are handed to the pool at a time; everything
+    else stays in our queues where it can still be reordered or cancelled.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._pool = self._new_pool()
+        self._pool_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._queues = {p: OrderedDict() for p in PRIORITIES}
+        self._in_flight = 0
+        # Latest script-run generation seen per session (see begin_run)
+        self._generations = {}
+        # Recent submit-to-done latencies of interactive jobs, per stage (function name)
+        self._latencies = {}
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="render-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    # --- PUBLIC API ---
+    def submit(self, session_id, fn, *args, priority=INTERACTIVE, generation=None, **kwargs):
+        """Queue fn(*args, **kwargs) for a session; returns a Future.
+        fn must be a module-level function (it is looked up by name in the worker).
+        Jobs tagged with a generation are dropped once that session starts a newer run."""
+        job = _Job(session_id, fn, args, kwargs, priority, generation)
+        with self._cond:
+            self._queues[priority].setdefault(session_id, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def begin_run(self, session_id, generation):
+        """
+        Called at the top of every script run with an increasing generation.
+        Queued jobs tagged with an older generation of this session are stale
+        (the widgets they rendered for have changed) and are cancelled, now
+        and whenever the dispatcher meets one. Untagged jobs (downloads,
+        print exports) are kept. Jobs already handed to the pool run to
+        completion. Callers wait in short, interruptible ticks, so a run that
+        Streamlit stops for a rerun leaves its remaining jobs queued here.
+        """
+        stale = []
+        with self._cond:
+            self._generations[session_id] = generation
+            for level in self._queues.values():
+                queue = level.get(session_id)
+                if not queue:
+                    continue
+                keep = deque()
+                for job in queue:
+                    (stale if self._is_stale(job) else keep).append(job)
+                if keep:
+                    level[session_id] = keep
+                else:
+                    del level[session_id]
+
+            # Forget sessions with nothing queued; their next run re-registers them
+            queued = {sid for level in self._queues.values() for sid in level}
+            for sid in [sid for sid in self._generations if sid != session_id and sid not in queued]:
+                del self._generations[sid]
+        for job in stale:
+            job.future.cancel()
+
+    def queue_depth(self):
+        """Number of queued (not yet dispatched) jobs across all sessions"""
+        with self._cond:
+            return sum(len(q) for level in self._queues.values() for q in level.values())
+
+    def recent_latencies(self, stages=None, window=30.0):
+        """Interactive latencies (seconds) finished in the last `window` seconds, optionally per stage"""
+        cutoff = time.monotonic() - window
+        with self._cond:
+            return [t for name, samples in self._latencies.items()
+                    if stages is None or name in stages
+                    for done, t in samples if done >= cutoff]
+
+    # --- POOL ---
+    def _new_pool(self):
+        # Never fork: the dispatcher and Streamlit's server threads are running
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=ctx)
+
+    def _rebuild_pool(self, broken):
+        """Replace a pool whose worker died (OOM, codec segfault); once per broken pool"""
+        with self._pool_lock:
+            if self._pool is not broken:
+                return
+            logger.error("Render worker died; rebuilding the render pool")
+            self._pool = self._new_pool()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _launch(self, job):
+        """Hand a job to the current pool, rebuilding it once if it is already broken"""
+        for attempt in range(2):
+            pool = self._pool
+            try:
+                pool_future = pool.submit(_call, job.module, job.name, job.args, job.kwargs)
+            except BrokenProcessPool as e:
+                self._rebuild_pool(pool)
+                if attempt:
+                    self._finish(job, None, e)
+                continue
+            except Exception as e:
+                self._finish(job, None, e)
+                return
+            pool_future.add_done_callback(lambda f, job=job, pool=pool: self._on_done(job, pool, f))
+            return
+
+    # --- DISPATCH ---
+    def _is_stale(self, job):
+        return job.generation is not None and job.generation < self._generations.get(job.session_id, job.generation)
+
+    def _next_job(self):
+        """Pop the next job: highest priority first, round-robin over sessions"""
+        for priority in PRIORITIES:
+            level = self._queues[priority]
+            while level:
+                session_id, queue = next(iter(level.items()))
+                job = queue.popleft()
+                # Rotate this session to the back of the line
+                del level[session_id]
+                if queue:
+                    level[session_id] = queue
+                if self._is_stale(job):
+                    job.future.cancel()
+                    continue
+                if job.future.set_running_or_notify_cancel():
+                    return job
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                job = None
+                while job is None:
+                    if self._in_flight < self.max_workers:
+                        job = self._next_job()
+                    if job is None:
+                        self._cond.wait()
+                self._in_flight += 1
+
+            self._launch(job)
+
+    def _on_done(self, job, pool, pool_future):
+        if pool_future.cancelled():
+            error = BrokenProcessPool("render pool was shut down")
+        else:
+            error = pool_future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # The pool cannot tell which job killed the worker, so nothing is
+            # retried automatically; jobs fail and the next submit gets a fresh pool
+            self._rebuild_pool(pool)
+        self._finish(job, None if error else pool_future.result(), error)
+
+    def _finish(self, job, result, error):
+        with self._cond:
+            self._in_flight -= 1
+            if error is None and job.priority == INTERACTIVE:
+                samples = self._latencies.setdefault(job.name, deque(maxlen=64))
+                now = time.monotonic()
+                samples.append((now, now - job.submitted))
+            self._cond.notify()
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+
+# --- LOAD-AWARE QUALITY ---
+FULL = "full"
+DEGRADED = "degraded"
+
+QUALITY_SETTINGS = {
+    FULL: {"scale": 1.0, "fast": False, "output_format": "PNG"},
+    DEGRADED: {"scale": 0.6, "fast": True, "output_format": "JPEG"},
+}
+
+
+class QualityController:
+    """
+    Picks interactive render quality from scheduler load.
+
+    Switches to DEGRADED when the p95 of recent process_image/create_strip
+    latencies breaches the SLO or too many jobs are queued, and back to FULL
+    only once both fall below recover_ratio of their limits and the current
+    mode has been held for at least min_dwell seconds (hysteresis, so the
+    booth does not flap between looks). Downloads never consult this.
+    """
+
+    STAGES = ("process_image", "create_strip")
+
+    def __init__(self, scheduler, latency_slo=1.0, queue_slo=None, recover_ratio=0.5, min_dwell=10.0):
+        self.scheduler = scheduler
+        self.latency_slo = latency_slo
+        self.queue_slo = queue_slo or scheduler.max_workers * 2
+        self.recover_ratio = recover_ratio
+        self.min_dwell = min_dwell
+        self.mode = FULL
+        self.switch_counts = {FULL: 0, DEGRADED: 0}
+        self._since = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _p95(self):
+        samples = sorted(self.scheduler.recent_latencies(self.STAGES))
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def update(self):
+        """Re-evaluate load and return the current mode"""
+        p95 = self._p95()
+        depth = self.scheduler.queue_depth()
+        now = time.monotonic()
+
+        with self._lock:
+            if now - self._since < self.min_dwell:
+                return self.mode
+
+            if self.mode == FULL:
+                breach = p95 > self.latency_slo or depth > self.queue_slo
+                target = DEGRADED if breach else FULL
+            else:
+                recovered = (p95 < self.latency_slo * self.recover_ratio
+                             and depth <= self.queue_slo * self.recover_ratio)
+                target = FULL if recovered else DEGRADED
+
+            if target != self.mode:
+                self.switch_counts[target] += 1
+                logger.warning("Render quality %s -> %s (p95=%.2fs, queued=%d, switches=%s)",
+                               self.mode, target, p95, depth, self.switch_counts)
+                self.mode = target
+                self._since = now
+            return self.mode
+
+    def settings(self):
+        """Interactive render settings for the current load"""
+        return QUALITY_SETTINGS[self.update()]
@@ -4,8 +4,16 @@ import io
 import random
 import os
 import platform
+from collections import namedtuple
+from functools import lru_cache
+
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow built without littlecms
+    ImageCms = None
 
 # --- FONT HELPERS ---
+@lru_cache(maxsize=64)
 def load_font(size=40, font_type="regular", style="Modern Sans"):
     """
     Robust font loading with expanded style support using local assets.
@@ -115,25 +123,28 @@ def apply_fuji_velvia(image):
     cyan = ImageOps.colorize(gray, "#001A1A", "#FFFFFF")
     return Image.blend(img, cyan, 0.1)
 
-def apply_polaroid_600(image):
+def apply_polaroid_600(image, blur=True):
     # Faded, warm, slightly blurry, aesthetic.
     gray = ImageOps.grayscale(image)
     # Shadow: Muted Blueish, Highlights: Warm Rose
     polaroid = ImageOps.colorize(gray, "#1A1A2E", "#FFFDF5")
     img = Image.blend(image, polaroid, 0.5)
-    img = img.filter(ImageFilter.GaussianBlur(0.3))
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(0.3))
     enhancer = ImageEnhance.Contrast(img)
     img = enhancer.enhance(0.85)
     enhancer = ImageEnhance.Brightness(img)
     return enhancer.enhance(1.1)
 
-def apply_ilford_hp5(image):
+def apply_ilford_hp5(image, grain=True):
     # Classic Grainy B&W
     try:
         img = ImageOps.grayscale(image)
         enhancer = ImageEnhance.Contrast(img)
         img = enhancer.enhance(1.5)
         img = img.convert("RGB")
+        if not grain:
+            return img
         
         # Try to add grain, but abort if numpy fails
         try:
@@ -199,31 +210,61 @@ FILTER_MAP = {
     "Original": lambda x: x
 }
 
-def process_image(image, filter_name, flip=False):
-    """Process image with cropping, resizing, flipping, and filters"""
+# Cheaper variants used for interactive previews under load (no grain / blur stages)
+FAST_FILTER_MAP = {
+    "Polaroid 600": lambda x: apply_polaroid_600(x, blur=False),
+    "Ilford HP5 (B&W)": lambda x: apply_ilford_hp5(x, grain=False),
+}
+
+def load_capture(source, max_side=1200):
+    """
+    Decode a camera grab or upload once, square-cropped and capped at max_side.
+    Every render only ever uses the centre square, and keeping captures small
+    keeps each render job cheap to ship to the worker pool.
+    """
+    image = Image.open(source)
+    if image.format == "JPEG":
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft("RGB", (max_side, max_side))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    side = min(image.size)
+    left = (image.width - side) // 2
+    top = (image.height - side) // 2
+    image = image.crop((left, top, left + side, top + side))
+    if side > max_side:
+        image = image.resize((max_side, max_side), Image.Resampling.LANCZOS)
+    return image
+
+def prepare_image(image, size=600, flip=False, fast=False):
+    """Shared prefix of every render: RGB convert, square crop, resize, mirror"""
     # 1. Normalize to RGB immediately to prevent mode conflicts
     if image.mode != "RGB":
         image = image.convert("RGB")
 
     # 2. Square Crop
     if image.width != image.height:
-        size = min(image.size)
-        left = (image.width - size) / 2
-        top = (image.height - size) / 2
-        right = (image.width + size) / 2
-        bottom = (image.height + size) / 2
+        side = min(image.size)
+        left = (image.width - side) / 2
+        top = (image.height - side) / 2
+        right = (image.width + side) / 2
+        bottom = (image.height + side) / 2
         image = image.crop((left, top, right, bottom))
     
     # 3. Resize
-    image = image.resize((600, 600), Image.Resampling.LANCZOS)
+    image = image.resize((size, size), Image.Resampling.BILINEAR if fast else Image.Resampling.LANCZOS)
     
     # 4. Mirror
     if flip:
         image = ImageOps.mirror(image)
+    return image
 
-    # 5. Apply Filter using Direct Mapping
+def apply_filter(image, filter_name, fast=False):
+    """Apply a film stock by name to an already prepared image"""
+    # Apply Filter using Direct Mapping
     # Default to Original if key missing or partial match failure
-    filter_func = FILTER_MAP.get(filter_name)
+    filter_func = (fast and FAST_FILTER_MAP.get(filter_name)) or FILTER_MAP.get(filter_name)
     
     # Fallback for "Contains" matching if exact key fails (Legacy support)
     if not filter_func:
@@ -244,67 +285,195 @@ def process_image(image, filter_name, flip=False):
         print(f"Filter Error: {e}")
         return image
 
+def process_image(image, filter_name, flip=False, size=600, fast=False):
+    """Process image with cropping, resizing, flipping, and filters.
+    fast=True swaps in FAST_FILTER_MAP variants for load-shedding previews."""
+    return apply_filter(prepare_image(image, size, flip, fast), filter_name, fast)
+
+def filter_contact_sheet(image, flip=False, size=600, thumb_size=200, fast=False):
+    """
+    Preview every FILTER_MAP entry in one pass. The shared prefix runs once;
+    returns (prepared base at `size`, {filter_name: thumbnail}) so the base can
+    be reused for whichever stock the guest picks.
+    """
+    base = prepare_image(image, size, flip, fast)
+    thumb = base.resize((thumb_size, thumb_size), Image.Resampling.BILINEAR)
+    return base, {name: apply_filter(thumb, name, fast) for name in FILTER_MAP}
+
+# --- BURST CAPTURE ---
+def score_sharpness(image, size=512):
+    """
+    Score frame sharpness as Laplacian variance on a centre crop. The crop
+    covers about half the frame's short side and is box-reduced to `size`
+    before grayscale conversion: small enough to be fast, fine enough that
+    camera shake still shows.
+    """
+    factor = max(1, min(image.size) // (size * 2))
+    side = min(size * factor, *image.size)
+    left = (image.width - side) // 2
+    top = (image.height - side) // 2
+    crop = image.crop((left, top, left + side, top + side))
+    gray = (crop.reduce(factor) if factor > 1 else crop).convert("L")
+
+    px = np.asarray(gray, dtype=np.float32)
+    if px.shape[0] < 3 or px.shape[1] < 3:
+        return 0.0
+
+    # 4-neighbour Laplacian via array slicing (no per-pixel Python loop)
+    lap = (px[:-2, 1:-1] + px[2:, 1:-1] + px[1:-1, :-2] + px[1:-1, 2:]
+           - 4.0 * px[1:-1, 1:-1])
+    return float(lap.var())
+
+def pick_sharpest(images, size=512):
+    """Return (index, scores) of the sharpest frame in a burst"""
+    scores = [score_sharpness(img, size=size) for img in images]
+    best = int(np.argmax(scores)) if scores else -1
+    return best, scores
+
+# --- LAYOUT ENGINE ---
+# Grid layouts as (rows, cols). Classic Strip is a single column sized to the capture count.
+LAYOUTS = {
+    "Classic Strip": (None, 1),
+    "2x2 Square": (2, 2),
+    "1x3 Landscape": (1, 3),
+    "2x3 Grid": (2, 3),
+}
+
+LayoutPlan = namedtuple(
+    "LayoutPlan",
+    ["size", "photo_size", "photo_boxes", "title_xy", "footer_xy", "date_xy",
+     "font_sizes", "exclusion_zones", "border"],
+)
+
+def layout_photo_count(layout, strip_length=3):
+    """How many captures a layout needs"""
+    rows, cols = LAYOUTS.get(layout, LAYOUTS["Classic Strip"])
+    return (rows or strip_length) * cols
+
+@lru_cache(maxsize=64)
+def get_layout_plan(layout="Classic Strip", num_photos=3, scale=1.0, has_footer=True, has_date=False):
+    """
+    Precompute all strip geometry for a layout: canvas size, paste boxes,
+    text anchors, font sizes and pattern exclusion zones. Cached, so a
+    render only pastes and draws. The footer and date bands are only kept
+    clear of patterns when that text is actually drawn.
+    """
+    rows, cols = LAYOUTS.get(layout, LAYOUTS["Classic Strip"])
+    rows = rows or num_photos
+
+    photo = int(600 * scale)
+    padding = int(50 * scale)
+    header_h = int(100 * scale)
+    footer_h = int(150 * scale)
+
+    strip_w = cols * photo + (cols + 1) * padding
+    strip_h = header_h + rows * (photo + padding) + footer_h
+
+    boxes = []
+    for r in range(rows):
+        for c in range(cols):
+            x = padding + c * (photo + padding)
+            y = header_h + r * (photo + padding)
+            boxes.append((x, y, x + photo, y + photo))
+    boxes = tuple(boxes)
+
+    footer_y = strip_h - int(100 * scale)
+    title_size, footer_size, date_size = int(60 * scale), int(40 * scale), int(25 * scale)
+    title_xy = (strip_w / 2, header_h / 2)
+    footer_xy = (strip_w / 2, footer_y)
+    date_xy = (strip_w / 2, footer_y + int(50 * scale))
+
+    # Keep patterns off the photos and off full-width bands behind the title, footer and date
+    texts = [(title_xy, title_size)]
+    if has_footer:
+        texts.append((footer_xy, footer_size))
+    if has_date:
+        texts.append((date_xy, date_size))
+    text_bands = tuple(
+        (0, int(y - font_size * 0.75), strip_w, int(y + font_size * 0.75))
+        for (_, y), font_size in texts
+    )
+
+    return LayoutPlan(
+        size=(strip_w, strip_h),
+        photo_size=(photo, photo),
+        photo_boxes=boxes,
+        title_xy=title_xy,
+        footer_xy=footer_xy,
+        date_xy=date_xy,
+        font_sizes=(title_size, footer_size, date_size),
+        exclusion_zones=boxes + text_bands,
+        border=max(1, int(5 * scale)),
+    )
+
 # --- STICKER ASSETS ---
-def draw_pattern(draw, strip_width, strip_height, pattern_type, density):
-    """Draw geometric patterns on the strip borders (No Emojis)"""
+def _hits_zone(x, y, reach, zones):
+    """True if a shape centred near (x, y) with the given reach overlaps any zone"""
+    for x0, y0, x1, y1 in zones:
+        if x + reach >= x0 and x - reach <= x1 and y + reach >= y0 and y - reach <= y1:
+            return True
+    return False
+
+def draw_pattern(draw, strip_width, strip_height, pattern_type, density, scale=1.0, exclusion_zones=None,
+                 seed=None):
+    """Draw geometric patterns on the strip borders (No Emojis).
+    The same seed gives the same decorations, so preview, download and print match."""
     if pattern_type == "None":
         return
 
+    rng = random.Random(seed)
+
+    # Keep shapes off the photos; without a layout plan, assume the classic middle photo column
+    if exclusion_zones is None:
+        inner = int(100 * scale)
+        exclusion_zones = ((inner, 0, strip_width - inner, strip_height),)
+
     num_shapes = int(density * 5) + 10
     
     # Define color palette based on vintage vibe
     colors = ["#D4AF37", "#8B5E3C", "#A52A2A", "#2C3E50", "#E67E22", "#27AE60"]
     
     for _ in range(num_shapes):
-        x = random.randint(0, strip_width)
-        y = random.randint(0, strip_height)
-        
-        # Bias towards edges (keep center clear for photos)
-        if random.random() > 0.2:
-             if random.choice([True, False]):
-                x = random.randint(0, 60)
-             else:
-                x = random.randint(strip_width - 60, strip_width)
-        else:
-             # Randomly re-roll if it lands in the middle photo area
-             if 100 < x < strip_width - 100:
-                 continue
+        color = rng.choice(colors)
+        size = max(1, int(rng.randint(5, 15) * scale))
+        reach = int(20 * scale) if pattern_type == "Minimal Lines" else size
 
-        color = random.choice(colors)
-        size = random.randint(5, 15)
+        # Re-roll a few times if it lands on a photo
+        for _attempt in range(10):
+            x = rng.randint(0, strip_width)
+            y = rng.randint(0, strip_height)
+            if not _hits_zone(x, y, reach, exclusion_zones):
+                break
+        else:
+            continue
         
         if pattern_type == "Polka Dots":
             draw.ellipse([x, y, x+size, y+size], fill=color)
             
         elif pattern_type == "Confetti":
             # Random rectangles and triangles
-            if random.choice([True, False]):
+            if rng.choice([True, False]):
                 draw.rectangle([x, y, x+size, y+size], fill=color)
             else:
                 draw.polygon([(x, y), (x+size, y+size), (x-size, y+size)], fill=color)
                 
         elif pattern_type == "Stars":
             # Simple Cross/Star shape
-            draw.line((x - size, y, x + size, y), fill=color, width=2)
-            draw.line((x, y - size, x, y + size), fill=color, width=2)
+            draw.line((x - size, y, x + size, y), fill=color, width=max(1, int(2 * scale)))
+            draw.line((x, y - size, x, y + size), fill=color, width=max(1, int(2 * scale)))
             
         elif pattern_type == "Minimal Lines":
-            # Horizontal dashes near edges
-            if x < 100 or x > strip_width - 100:
-                draw.line((x, y, x+20, y), fill="#333", width=3)
+            # Horizontal dashes in the borders
+            draw.line((x, y, x + int(20 * scale), y), fill="#333", width=max(1, int(3 * scale)))
 
 def create_strip(images, footer_text="Photobooth", frame_style="Cream", text_color="#333", 
                  include_date=False, custom_border_color=None, pattern_type="None", 
-                 sticker_density=5, font_style="Modern Sans"):
-    """Create the final photo strip with all customizations"""
-    photo_w, photo_h = 600, 600
-    padding = 50
-    header_h = 100
-    footer_h = 150
-    
-    num_photos = len(images)
-    strip_w = photo_w + (padding * 2)
-    strip_h = header_h + (num_photos * (photo_h + padding)) + footer_h
+                 sticker_density=5, font_style="Modern Sans", scale=1.0,
+                 layout="Classic Strip", pattern_seed=None):
+    """Create the final photo strip with all customizations.
+    scale < 1 gives a cheaper preview; downloads use the default."""
+    plan = get_layout_plan(layout, len(images), scale, has_footer=bool(footer_text), has_date=include_date)
+    strip_w, strip_h = plan.size
     
     # Frame color selection
     bg_color = "#F5F1E8"
@@ -321,52 +490,124 @@ def create_strip(images, footer_text="Photobooth", frame_style="Cream", text_col
     elif frame_style == "Custom" and custom_border_color:
         bg_color = custom_border_color
         
-    strip = Image.new("RGB", (strip_w, strip_h), color=bg_color)
+    strip = Image.new("RGB", plan.size, color=bg_color)
     draw = ImageDraw.Draw(strip)
     
-    y_offset = header_h
-    
     # Auto-adjust text color for dark frames
     if frame_style in ["Black", "Film Noir"]:
         text_color = "#FFFFFF" if text_color == "#333" else text_color
     
     # Paste photos
-    for img in images:
-        img = img.resize((photo_w, photo_h))
+    for img, box in zip(images, plan.photo_boxes):
+        if img.size != plan.photo_size:
+            img = img.resize(plan.photo_size)
         if frame_style == "Film Noir":
-            img_border = ImageOps.expand(img, border=5, fill="white")
-            img_border = img_border.resize((photo_w, photo_h))
-            strip.paste(img_border, (padding, y_offset))
+            img_border = ImageOps.expand(img, border=plan.border, fill="white")
+            img_border = img_border.resize(plan.photo_size)
+            strip.paste(img_border, box[:2])
         else:
-            strip.paste(img, (padding, y_offset))
-        y_offset += photo_h + padding
+            strip.paste(img, box[:2])
 
     # Draw Patterns (Replaces Stickers)
     if pattern_type != "None":
-        draw_pattern(draw, strip_w, strip_h, pattern_type, sticker_density)
+        draw_pattern(draw, strip_w, strip_h, pattern_type, sticker_density, scale, plan.exclusion_zones,
+                     pattern_seed)
 
     # Add text with selected font style
-    font_title = load_font(60, "title", style=font_style)
+    title_size, footer_size, date_size = plan.font_sizes
+    font_title = load_font(title_size, "title", style=font_style)
     # Ensure footer uses the same decorative style, but regular weight
-    font_footer = load_font(40, "regular", style=font_style)
+    font_footer = load_font(footer_size, "regular", style=font_style)
     
-    draw.text((strip_w/2, 50), "PHOTOBOOTH", fill=text_color, font=font_title, anchor="mm")
+    draw.text(plan.title_xy, "PHOTOBOOTH", fill=text_color, font=font_title, anchor="mm")
     
-    footer_y = strip_h - 100
-    draw.text((strip_w/2, footer_y), footer_text, fill=text_color, font=font_footer, anchor="mm")
+    draw.text(plan.footer_xy, footer_text, fill=text_color, font=font_footer, anchor="mm")
     
     if include_date:
         from datetime import datetime
         date_str = datetime.now().strftime("%Y-%m-%d")
         # Ensure date also uses the selected style
-        draw.text((strip_w/2, footer_y + 50), date_str, fill=text_color, 
-                 font=load_font(25, "regular", style=font_style), anchor="mm")
+        draw.text(plan.date_xy, date_str, fill=text_color, 
+                 font=load_font(date_size, "regular", style=font_style), anchor="mm")
         
     return strip 
 
+# --- PRINT EXPORT (COLOR MANAGEMENT) ---
+# Printer profiles live in an operator-configured directory; guests only ever see their names
+ICC_DIR = os.environ.get("PHOTOBOOTH_ICC_DIR", "")
+SRGB_PROFILE = "sRGB (built-in)"
+
+RENDERING_INTENTS = {
+    "Perceptual": 0,
+    "Relative Colorimetric": 1,
+    "Saturation": 2,
+    "Absolute Colorimetric": 3,
+}
+
+def list_print_profiles():
+    """Names of the .icc/.icm printer profiles in ICC_DIR (empty when none are configured)"""
+    if not ICC_DIR or not os.path.isdir(ICC_DIR):
+        return []
+    return sorted(name for name in os.listdir(ICC_DIR) if name.lower().endswith((".icc", ".icm")))
+
+@lru_cache(maxsize=16)
+def _load_profile(profile):
+    """Open an ICC profile once; accepts the built-in sRGB name or a profile name from ICC_DIR"""
+    if profile == SRGB_PROFILE:
+        return ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB"))
+    if profile not in list_print_profiles():
+        raise ValueError(f"Unknown print profile: {profile}")
+    return ImageCms.ImageCmsProfile(os.path.join(ICC_DIR, profile))
+
+def _profile_mode(profile):
+    """PIL image mode matching the profile's color space"""
+    space = _load_profile(profile).profile.xcolor_space.strip()
+    return {"CMYK": "CMYK", "GRAY": "L"}.get(space, "RGB")
+
+@lru_cache(maxsize=32)
+def get_icc_transform(src_profile, dst_profile, intent="Perceptual"):
+    """Build an ImageCms transform once per (source, destination, intent)"""
+    return ImageCms.buildTransform(
+        _load_profile(src_profile),
+        _load_profile(dst_profile),
+        "RGB",
+        _profile_mode(dst_profile),
+        renderingIntent=RENDERING_INTENTS.get(intent, 0),
+    )
+
+def convert_for_print(image, dst_profile, intent="Perceptual", src_profile=SRGB_PROFILE):
+    """Convert an sRGB strip to the printer profile and tag it with that profile"""
+    if ImageCms is None:
+        raise RuntimeError("Color management needs Pillow built with littlecms")
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    transform = get_icc_transform(src_profile, dst_profile, intent)
+    out = ImageCms.applyTransform(image, transform)
+    out.info["icc_profile"] = _load_profile(dst_profile).tobytes()
+    return out
+
+def export_for_print(image, dst_profile, intent="Perceptual"):
+    """Color-managed export. Returns (bytes, mime, extension)"""
+    out = convert_for_print(image, dst_profile, intent)
+    icc = out.info["icc_profile"]
+    buf = io.BytesIO()
+    if out.mode == "CMYK":
+        # PNG cannot hold CMYK, so print profiles of that kind go out as TIFF
+        out.save(buf, format="TIFF", icc_profile=icc, compression="tiff_lzw")
+        return buf.getvalue(), "image/tiff", "tiff"
+    out.save(buf, format="PNG", icc_profile=icc)
+    return buf.getvalue(), "image/png", "png"
+
 def convert_to_bytes(image):
     """Convert PIL image to bytes for download"""
     buf = io.BytesIO()
     image.save(buf, format="PNG")
     byte_im = buf.getvalue()
     return byte_im
+
+def render_download(images, filter_name, flip=False, **strip_options):
+    """Full-quality strip and its PNG bytes in one job"""
+    processed = [process_image(img, filter_name, flip=flip) for img in images]
+    strip = create_strip(processed, **strip_options)
+    return strip, convert_to_bytes(strip)